@@ -1,17 +1,100 @@
+import atexit
+import logging
 import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
 from flask import Flask
+from flask.json.provider import JSONProvider
 from dotenv import load_dotenv
 
+from .cache import LRUCache
+
+try:
+    import orjson
+except ImportError:  # orjson is an optional accelerator
+    orjson = None
+
+
+class _OrjsonProvider(JSONProvider):
+    """
+    JSON provider backed by orjson, whose native serializer is several
+    times faster than the stdlib on the large record payloads this app
+    returns. OPT_SERIALIZE_NUMPY covers the numpy scalars produced by
+    the calculators.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 load_dotenv()
 
+
+def _configure_logging():
+    """
+    Routes log from the request path, and a synchronous stream handler
+    makes every log call pay for the write (and its lock) inline. Log
+    records are instead dropped onto a queue and emitted by a
+    QueueListener thread, so request handlers never block on I/O.
+    """
+    root = logging.getLogger()
+    if any(isinstance(handler, QueueHandler) for handler in root.handlers):
+        return
+
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s %(name)s: %(message)s'
+    ))
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+
+
 def create_app():
+    _configure_logging()
     app = Flask(__name__)
 
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
-    # In-memory session store
-    app.sessions = {}
+    if orjson is not None:
+        app.json = _OrjsonProvider(app)
+
+    def _remove_orphaned_spill(data_path):
+        """
+        Deletes a session spill file once neither a live session nor a
+        cached calculator references it, so evicted pedigrees do not
+        accumulate on disk.
+        """
+        if any(entry[0] == data_path for entry in app.calculator_cache.values()):
+            return
+        if any(sess.get('data_path') == data_path for sess in app.sessions.values()):
+            return
+        try:
+            os.remove(data_path)
+        except OSError:
+            pass
+
+    # In-memory session store, bounded so long-running processes do not
+    # accumulate every session ever started.
+    app.sessions = LRUCache(
+        maxsize=32,
+        on_evict=lambda session_id, sess: _remove_orphaned_spill(sess['data_path']),
+    )
+
+    # Finished calculators keyed by pedigree content digest, so
+    # re-submitting the same data reuses the pre-computed IBCs.
+    app.calculator_cache = LRUCache(
+        maxsize=16,
+        on_evict=lambda digest, entry: _remove_orphaned_spill(entry[0]),
+    )
 
     # Register blueprints
     from .routes import main_blueprint
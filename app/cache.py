@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Minimal thread-safe bounded mapping with least-recently-used
+    eviction. Used for the per-process session and calculator stores so
+    their memory use is O(maxsize) instead of growing with every session
+    ever started.
+    """
+
+    def __init__(self, maxsize=32, on_evict=None):
+        """
+        on_evict, if given, is called as on_evict(key, value) for every
+        entry dropped by LRU eviction (outside the cache lock, so the
+        callback may inspect this or other caches).
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._on_evict = on_evict
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._data[key]
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        evicted = []
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False))
+        if self._on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self._on_evict(evicted_key, evicted_value)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def values(self):
+        """Snapshot of the stored values; does not touch LRU recency."""
+        with self._lock:
+            return list(self._data.values())
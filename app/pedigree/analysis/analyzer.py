@@ -1,149 +1,475 @@
+"""
+Pedigree inbreeding algorithms.
+
+There is exactly one implementation of each method: the sparse
+Meuwissen-Luo tabular recursion (plus a dense relationship-matrix
+builder for pairwise queries) and the traditional path-counting method.
+Both operate on the positional SoA arrays produced by positional_arrays;
+PedigreeCalculator is the only intended caller.
+"""
+
+from collections import deque
 
 import pandas as pd
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:  # numba is an optional accelerator
+    njit = None
+
 # --- ALGORITHM 1: Tabular Method (Meuwissen-Luo) ---
 
+def _topological_order(ids, parent_map):
+    """
+    Orders animal ids so that every parent precedes its offspring.
+    Composite string ids do not sort that way, so a proper topological
+    sort (Kahn's algorithm) is needed before the recursion can run.
+    Animals caught in a parentage cycle (a data error) are appended at
+    the end in their original order.
+    """
+    in_pedigree = set(ids)
+    children = {}
+    indegree = {}
+    for animal_id in ids:
+        sire_id, dam_id = parent_map[animal_id]
+        degree = 0
+        for parent_id in (sire_id, dam_id):
+            if pd.notna(parent_id) and parent_id in in_pedigree:
+                degree += 1
+                children.setdefault(parent_id, []).append(animal_id)
+        indegree[animal_id] = degree
+
+    order = [animal_id for animal_id in ids if indegree[animal_id] == 0]
+    head = 0
+    while head < len(order):
+        current_id = order[head]; head += 1
+        for child_id in children.get(current_id, ()):
+            indegree[child_id] -= 1
+            if indegree[child_id] == 0:
+                order.append(child_id)
+
+    if len(order) < len(ids):
+        placed = set(order)
+        order.extend(animal_id for animal_id in ids if animal_id not in placed)
+    return order
+
+
+def _tabular_kernel(sires, dams):
+    """
+    Core Meuwissen-Luo recursion over positional parent arrays
+    (-1 for missing), parents always preceding offspring.
+    Computes only the diagonal inbreeding values F[i] by walking the
+    in-pedigree ancestors of each animal — the full N x N relationship
+    matrix is never materialized, so memory stays O(N) and work is
+    proportional to the actual ancestor counts.
+    """
+    n = sires.shape[0]
+    F = np.zeros(n)
+    D = np.zeros(n)            # Mendelian sampling variances
+    L = np.zeros(n)            # scratch: path coefficients for the current animal
+    visited = np.zeros(n, dtype=np.bool_)
+    stack = np.empty(n, dtype=np.int64)
+    ancestors = np.empty(n, dtype=np.int64)
+
+    for i in range(n):
+        s = sires[i]
+        d = dams[i]
+        f_s = F[s] if s >= 0 else -1.0
+        f_d = F[d] if d >= 0 else -1.0
+        D[i] = 0.5 - 0.25 * (f_s + f_d)
+        # Founders and single-parent animals have F = 0 by convention.
+        if s < 0 or d < 0:
+            continue
+
+        # Collect the in-pedigree ancestors of i (including i itself).
+        count = 0
+        top = 0
+        stack[top] = i; top += 1
+        visited[i] = True
+        while top > 0:
+            top -= 1
+            current = stack[top]
+            ancestors[count] = current; count += 1
+            p = sires[current]
+            if p >= 0 and not visited[p]:
+                visited[p] = True
+                stack[top] = p; top += 1
+            p = dams[current]
+            if p >= 0 and not visited[p]:
+                visited[p] = True
+                stack[top] = p; top += 1
+
+        # Accumulate A[i,i] = sum(L[j]^2 * D[j]) over the ancestors,
+        # processing descendants before their parents (descending position).
+        found = np.sort(ancestors[:count])
+        L[i] = 1.0
+        f_i = -1.0
+        for k in range(count - 1, -1, -1):
+            j = found[k]
+            l_j = L[j]
+            s_j = sires[j]
+            d_j = dams[j]
+            if s_j >= 0:
+                L[s_j] += 0.5 * l_j
+            if d_j >= 0:
+                L[d_j] += 0.5 * l_j
+            f_i += l_j * l_j * D[j]
+        F[i] = f_i
+
+        # Reset the scratch arrays for the next animal (touched cells only).
+        for k in range(count):
+            j = found[k]
+            L[j] = 0.0
+            visited[j] = False
+
+    return F
+
+
+if njit is not None:
+    # The kernel is pure index/float arithmetic over plain arrays with
+    # explicit loops, so it compiles as-is; cache=True reuses the
+    # compiled code across worker processes.
+    _tabular_kernel = njit(cache=True)(_tabular_kernel)
+
+
+def positional_arrays(df):
+    """
+    Converts the pedigree dataframe into topologically ordered ids plus
+    positional sire/dam index arrays (int32, -1 for missing or foreign
+    parents). This compact SoA layout is the representation all the
+    algorithms below (and PedigreeCalculator) operate on.
+    """
+    # The animal_id is now a string, so the numeric conversion has been removed.
+    df = df.drop_duplicates(subset=['animal_id'])
+
+    # Bulk-unbox the three columns once; dict(zip(...)) skips the
+    # per-row namedtuple construction that itertuples would pay.
+    animal_ids = df['animal_id'].to_numpy().tolist()
+    sire_ids = df['sire_id'].to_numpy().tolist()
+    dam_ids = df['dam_id'].to_numpy().tolist()
+    parent_map = dict(zip(animal_ids, zip(sire_ids, dam_ids)))
+    ordered_ids = _topological_order(animal_ids, parent_map)
+    animal_pos = {animal_id: i for i, animal_id in enumerate(ordered_ids)}
+    n = len(ordered_ids)
+
+    # Positional parent arrays with -1 for missing/foreign parents, built
+    # with vectorized map/fillna instead of per-row dict lookups.
+    ordered = df.set_index('animal_id').loc[ordered_ids]
+    sires = ordered['sire_id'].map(animal_pos).fillna(-1).to_numpy(dtype=np.int32)
+    dams = ordered['dam_id'].map(animal_pos).fillna(-1).to_numpy(dtype=np.int32)
+
+    # A parent placed after its offspring can only come from a cyclic
+    # pedigree (a data error); treat such links as unknown parents.
+    positions = np.arange(n)
+    sires[sires >= positions] = -1
+    dams[dams >= positions] = -1
+
+    return ordered_ids, sires, dams
+
+
+def inbreeding_from_arrays(sires, dams):
+    """
+    Runs the sparse Meuwissen-Luo recursion directly over positional
+    parent arrays and returns the F vector. For callers that already hold
+    the SoA representation (e.g. PedigreeCalculator).
+    """
+    return _tabular_kernel(sires, dams)
+
+
 def calculate_inbreeding_tabular(df):
     """
     Calculates inbreeding coefficients for all animals in the dataframe
     using the tabular method (Meuwissen-Luo), which is robust and efficient.
+    Only the diagonal values are computed, via the sparse ancestor
+    recursion, so the cost scales with pedigree depth rather than N^2.
     """
-    # The animal_id is now a string, so the numeric conversion has been removed.
-    # Ensure indices are unique and sorted for consistent processing
-    df = df.drop_duplicates(subset=['animal_id']).set_index('animal_id').sort_index()
-    
-    animal_pos = {animal_id: i for i, animal_id in enumerate(df.index)}
-    n = len(df.index)
-    A = np.zeros((n, n))
-    
-    for i, animal_id in enumerate(df.index):
-        sire_id = df.loc[animal_id, 'sire_id']
-        dam_id = df.loc[animal_id, 'dam_id']
-        
-        # Get positions, handling cases where parents are not in the pedigree
-        sire_pos = animal_pos.get(sire_id, -1) if pd.notna(sire_id) else -1
-        dam_pos = animal_pos.get(dam_id, -1) if pd.notna(dam_id) else -1
-        
-        # Both parents known
-        if sire_pos != -1 and dam_pos != -1:
-            # Get coancestry between parents
-            coancestry = A[sire_pos, dam_pos] if sire_pos < dam_pos else A[dam_pos, sire_pos]
-            A[i, i] = 1 + 0.5 * coancestry
-            # Set relationship with other animals
-            for j in range(i):
-                val = 0.5 * (A[sire_pos, j] + A[dam_pos, j])
-                A[i, j] = A[j, i] = val
-        # Only one parent known
-        elif sire_pos != -1 or dam_pos != -1:
-            parent_pos = sire_pos if sire_pos != -1 else dam_pos
-            A[i, i] = 1.0
-            # Set relationship with other animals
-            for j in range(i):
-                val = 0.5 * A[parent_pos, j]
-                A[i, j] = A[j, i] = val
-        # No parents known (base animal)
+    ordered_ids, sires, dams = positional_arrays(df)
+    F = inbreeding_from_arrays(sires, dams)
+    return {animal_id: F[i] for i, animal_id in enumerate(ordered_ids)}
+
+
+# Column-tile width for dense relationship-matrix row updates; sized so
+# a few row slabs of this width fit comfortably in a typical L2 cache.
+_NRM_BLOCK = 4096
+
+
+def relationship_matrix_from_arrays(sires, dams, query_positions=None):
+    """
+    Builds the N x N additive relationship matrix directly over positional
+    parent arrays, with vectorized slice arithmetic (each row update is
+    two NumPy slice ops instead of a Python loop over columns). For
+    callers that already hold the SoA representation; the df entry point
+    below wraps this. The sparse recursion above is preferred when only
+    the inbreeding coefficients are needed; this builder is for workloads
+    that need arbitrary pairwise relationships, e.g. coancestry between
+    mating candidates.
+
+    When query_positions is given, off-diagonal rows are only computed
+    for animals that are parents or appear in query_positions; terminal
+    animals outside the query set get just their diagonal. Their
+    off-diagonal entries are never read - a parent's row is always
+    complete - so this skips the dominant O(N^2) work for the (typically
+    large) fraction of animals that never produce offspring.
+    """
+    n = sires.shape[0]
+    # float32 keeps coefficients well past the 4 decimals reported and
+    # halves both the matrix footprint and the bandwidth of the
+    # memory-bound row updates.
+    A = np.zeros((n, n), dtype=np.float32, order='C')
+
+    needed = np.zeros(n, dtype=np.bool_)
+    if query_positions is None:
+        needed[:] = True
+    else:
+        needed[sires[sires >= 0]] = True
+        needed[dams[dams >= 0]] = True
+        for pos in query_positions:
+            needed[pos] = True
+
+    # Row updates are tiled into fixed-width column chunks so the source
+    # and destination row slabs stay cache-resident while they are
+    # combined; the update is memory-bound, so this trims DRAM traffic
+    # on matrices that dwarf the last-level cache.
+    block = _NRM_BLOCK
+
+    # Founders contribute only a unit diagonal; set those in one
+    # vectorized pass and skip them in the main loop.
+    founder_mask = (sires < 0) & (dams < 0)
+    founder_positions = np.nonzero(founder_mask)[0]
+    A[founder_positions, founder_positions] = 1.0
+
+    for i in range(n):
+        if founder_mask[i]:
+            continue
+        s = sires[i]
+        d = dams[i]
+        if s >= 0 and d >= 0:
+            A[i, i] = 1.0 + 0.5 * A[s, d]
+            if needed[i]:
+                for cb in range(0, i, block):
+                    ce = min(cb + block, i)
+                    A[i, cb:ce] = 0.5 * (A[s, cb:ce] + A[d, cb:ce])
+                A[:i, i] = A[i, :i]
         else:
+            p = s if s >= 0 else d
             A[i, i] = 1.0
+            if needed[i]:
+                for cb in range(0, i, block):
+                    ce = min(cb + block, i)
+                    A[i, cb:ce] = 0.5 * A[p, cb:ce]
+                A[:i, i] = A[i, :i]
+
+    return A
 
-    inbreeding_coeffs = {animal_id: A[i, i] - 1 for i, animal_id in enumerate(df.index)}
-    return inbreeding_coeffs
+
+def calculate_relationship_matrix(df, query_ids=None):
+    """
+    Dataframe entry point for the relationship-matrix builder: converts
+    the pedigree to positional arrays, resolves query_ids (ids missing
+    from the pedigree are ignored) and returns (A, animal_pos).
+    """
+    ordered_ids, sires, dams = positional_arrays(df)
+    animal_pos = {animal_id: i for i, animal_id in enumerate(ordered_ids)}
+    query_positions = None
+    if query_ids is not None:
+        query_positions = [
+            pos for pos in (animal_pos.get(str(animal_id)) for animal_id in query_ids)
+            if pos is not None
+        ]
+    A = relationship_matrix_from_arrays(sires, dams, query_positions)
+    return A, animal_pos
 
 # --- ALGORITHM 2: Path-finding Method ---
+#
+# All path-based helpers operate on the positional SoA arrays produced
+# by positional_arrays: animals are compact int positions, parents are
+# looked up with plain array indexing, and -1 means "unknown parent"
+# (missing or not present in the pedigree).
+
+# Powers of one half up to the practical pedigree depth; the
+# contribution formula below looks them up instead of calling pow().
+_HALF_POW = 0.5 ** np.arange(64)
+
+
+def sum_path_contributions(sire_paths, dam_paths, ancestor_inbreeding):
+    """
+    Sums (0.5)^(n+m+1) * (1 + F_ancestor) over every pairing of sire and
+    dam path lengths as one broadcasted table lookup and reduction,
+    replacing the Python double loop over path combinations.
+    """
+    s = np.asarray(sire_paths)
+    d = np.asarray(dam_paths)
+    if s.size == 0 or d.size == 0:
+        return 0.0
+    exponents = s[:, None] + d[None, :] + 1
+    if int(exponents.max()) < _HALF_POW.shape[0]:
+        powers = _HALF_POW[exponents]
+    else:
+        # Deeper than the table (degenerate pedigrees); compute directly.
+        powers = 0.5 ** exponents
+    return powers.sum() * (1.0 + ancestor_inbreeding)
 
-def find_all_paths_to_ancestor(df_map, start_id, end_id):
-    """Finds all unique paths from a start animal to a specific ancestor."""
+
+def _ancestor_mask_kernel(sires, dams, start):
+    """
+    Marks the ancestor positions of the start animal (including itself)
+    in a boolean mask, using an explicit array stack so the traversal is
+    pure index arithmetic - njit-compiled when numba is available.
+    """
+    n = sires.shape[0]
+    mask = np.zeros(n, dtype=np.bool_)
+    stack = np.empty(n, dtype=np.int64)
+    top = 0
+    stack[top] = start; top += 1
+    mask[start] = True
+    while top > 0:
+        top -= 1
+        current = stack[top]
+        p = sires[current]
+        if p >= 0 and not mask[p]:
+            mask[p] = True
+            stack[top] = p; top += 1
+        p = dams[current]
+        if p >= 0 and not mask[p]:
+            mask[p] = True
+            stack[top] = p; top += 1
+    return mask
+
+
+if njit is not None:
+    _ancestor_mask_kernel = njit(cache=True)(_ancestor_mask_kernel)
+
+
+def collect_ancestor_mask(sires, dams, start):
+    """
+    Returns the ancestor positions of the start animal (including the
+    start animal itself) as a Python int bitmask, bit k set for position
+    k. Intersecting two ancestor sets is then a single big-int '&',
+    which CPython executes as a C-level loop over machine words instead
+    of a hashed set operation per element.
+    """
+    mask = _ancestor_mask_kernel(sires, dams, start)
+    return int.from_bytes(np.packbits(mask, bitorder='little').tobytes(), 'little')
+
+
+def iter_mask_positions(mask):
+    """
+    Yields the set bit positions of an ancestor bitmask in ascending
+    order via lowest-set-bit extraction.
+    """
+    while mask:
+        lsb = mask & -mask
+        yield lsb.bit_length() - 1
+        mask ^= lsb
+
+
+def enumerate_all_paths(sires, dams, start):
+    """
+    Enumerates the lengths of every ancestor path from the start position
+    in a single BFS sweep. Returns a dict mapping ancestor position ->
+    list of path lengths, so one traversal answers the path query for
+    every common ancestor at once instead of re-running a BFS per
+    (animal, ancestor) pair.
+    """
+    path_lengths = {}
+    queue = deque([(start, 0)])
+    while queue:
+        current, depth = queue.popleft()
+        path_lengths.setdefault(current, []).append(depth)
+        s = sires[current]
+        if s >= 0:
+            queue.append((s, depth + 1))
+        d = dams[current]
+        if d >= 0:
+            queue.append((d, depth + 1))
+    return path_lengths
+
+
+def find_all_paths_to_ancestor(sires, dams, start, end):
+    """
+    Finds the lengths of all unique paths from a start animal to a
+    specific ancestor. Only the depth is tracked (the contribution
+    formula needs nothing else), so the BFS enqueues (position, depth)
+    pairs instead of allocating a path-prefix list per step.
+    """
     all_paths = []
-    
-    # Queue for BFS: stores tuples of (current_animal_id, path_to_current)
-    queue = [(start_id, [])]
-    
+
+    queue = deque([(start, 0)])
+
     while queue:
-        current_id, path = queue.pop(0)
-        
-        # Add current animal to path
-        new_path = path + [current_id]
-        
+        current, depth = queue.popleft()
+
         # If we reached the target ancestor, store the path length and continue
-        if current_id == end_id:
-            all_paths.append(len(new_path) - 1)
+        if current == end:
+            all_paths.append(depth)
             # Do not explore further up from the ancestor on this path
             continue
 
-        # Get parents from the pre-built map
-        parents = df_map.get(current_id)
-        if parents:
-            sire_id, dam_id = parents
-            if pd.notna(sire_id):
-                queue.append((sire_id, new_path))
-            if pd.notna(dam_id):
-                queue.append((dam_id, new_path))
-                
+        s = sires[current]
+        if s >= 0:
+            queue.append((s, depth + 1))
+        d = dams[current]
+        if d >= 0:
+            queue.append((d, depth + 1))
+
     return all_paths
 
-def _calculate_inbreeding_for_animal_path_based(df_map, animal_id, F_cache):
+def _calculate_inbreeding_for_animal_path_based(sires, dams, animal, F_cache):
     """
-    Internal recursive function to calculate IBC for a single animal.
-    Uses a cache (F_cache) to store and retrieve already computed values.
+    Calculates the IBC of one animal, assuming its ancestors' values are
+    already present in F_cache (guaranteed by the ascending processing
+    order in the public entry point below).
     """
-    if animal_id in F_cache:
-        return F_cache[animal_id]
-
-    parents = df_map.get(animal_id)
-    if not parents or pd.isna(parents[0]) or pd.isna(parents[1]):
-        F_cache[animal_id] = 0.0
+    sire = sires[animal]
+    dam = dams[animal]
+    if sire < 0 or dam < 0:
         return 0.0
 
-    sire_id, dam_id = parents
-    
     # This is not a proper coancestry calculation, but follows the classic path-method logic
     # which finds common ancestors and sums their contributions.
-    
-    # Find ancestors for sire and dam
-    q_sire, q_dam = [sire_id], [dam_id]
-    sire_ancestors, dam_ancestors = {sire_id}, {dam_id}
-    
-    head = 0
-    while head < len(q_sire):
-        curr = q_sire[head]; head+=1
-        p = df_map.get(curr)
-        if p: 
-            if pd.notna(p[0]) and p[0] not in sire_ancestors: sire_ancestors.add(p[0]); q_sire.append(p[0])
-            if pd.notna(p[1]) and p[1] not in sire_ancestors: sire_ancestors.add(p[1]); q_sire.append(p[1])
+    sire_ancestors = collect_ancestor_mask(sires, dams, sire)
+    dam_ancestors = collect_ancestor_mask(sires, dams, dam)
+    common_ancestors = sire_ancestors & dam_ancestors
+
+    # Local alias so the per-ancestor calls resolve via LOAD_FAST instead
+    # of a module-global lookup on every iteration.
+    find_paths = find_all_paths_to_ancestor
 
-    head = 0
-    while head < len(q_dam):
-        curr = q_dam[head]; head+=1
-        p = df_map.get(curr)
-        if p:
-            if pd.notna(p[0]) and p[0] not in dam_ancestors: dam_ancestors.add(p[0]); q_dam.append(p[0])
-            if pd.notna(p[1]) and p[1] not in dam_ancestors: dam_ancestors.add(p[1]); q_dam.append(p[1])
-            
-    common_ancestors = sire_ancestors.intersection(dam_ancestors)
-    
     total_inbreeding = 0.0
-    for ancestor_id in common_ancestors:
-        # Recursively calculate the ancestor's own inbreeding coefficient
-        ancestor_inbreeding = _calculate_inbreeding_for_animal_path_based(df_map, ancestor_id, F_cache)
-        
+    for ancestor in iter_mask_positions(common_ancestors):
+        # The ancestor's own coefficient was computed in an earlier pass.
+        ancestor_inbreeding = F_cache[ancestor]
+
         # Find all paths from sire and dam to the common ancestor
-        sire_paths = find_all_paths_to_ancestor(df_map, sire_id, ancestor_id)
-        dam_paths = find_all_paths_to_ancestor(df_map, dam_id, ancestor_id)
-        
+        sire_paths = find_paths(sires, dams, sire, ancestor)
+        dam_paths = find_paths(sires, dams, dam, ancestor)
+
         # Sum the contributions from this ancestor
-        for n in sire_paths:
-            for m in dam_paths:
-                total_inbreeding += (0.5)**(n + m + 1) * (1 + ancestor_inbreeding)
-    
-    F_cache[animal_id] = total_inbreeding
+        total_inbreeding += sum_path_contributions(
+            sire_paths, dam_paths, ancestor_inbreeding
+        )
+
     return total_inbreeding
 
 
-def calculate_inbreeding_path_based_for_animal(df, animal_id, F_cache):
+def calculate_inbreeding_path_based_for_animal(sires, dams, animal, F_cache):
     """
-    Public-facing function to calculate IBC for a single animal using the path method.
-    It prepares a map for efficient parent lookup.
+    Public-facing function to calculate IBC for a single animal (given as
+    a position into the SoA arrays) using the path method.
+
+    Works iteratively: the animal's ancestors are processed in ascending
+    position (i.e. topological) order, so each step only reads cached
+    values and deep pedigrees cannot overflow the Python call stack.
     """
-    # Create a mapping for faster parent lookups
-    df_map = {row.animal_id: (row.sire_id, row.dam_id) for row in df.itertuples()}
-    return _calculate_inbreeding_for_animal_path_based(df_map, animal_id, F_cache)
+    cached = F_cache.get(animal)
+    if cached is not None:
+        return cached
+
+    # Bit positions come out of the mask in ascending (topological) order.
+    for pos in iter_mask_positions(collect_ancestor_mask(sires, dams, animal)):
+        if pos not in F_cache:
+            F_cache[pos] = _calculate_inbreeding_for_animal_path_based(
+                sires, dams, pos, F_cache
+            )
+    return F_cache[animal]
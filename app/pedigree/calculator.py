@@ -1,23 +1,97 @@
-import pandas as pd
+import numpy as np
+
 from .analysis import analyzer
 
 class PedigreeCalculator:
     def __init__(self, df):
         """
         Initializes the calculator with a pedigree dataframe.
-        The Meuwissen-Luo inbreeding coefficients are pre-calculated for speed.
-        A cache is prepared for the traditional path-based calculation.
+        The pedigree is converted once into a compact structure-of-arrays
+        form (topologically ordered positions plus int32 sire/dam index
+        arrays, -1 for unknown parents) that every algorithm operates on.
+        The Meuwissen-Luo inbreeding coefficients are pre-calculated for
+        speed; a cache is prepared for the traditional path-based
+        calculation.
         """
-        self.df = df.copy()
         # The animal_id, sire_id, and dam_id are now string-based composite keys.
         # The numeric conversion is no longer needed and was causing errors.
-        
-        # Pre-calculate all Meuwissen-Luo IBCs for fast retrieval
-        self.F_meuwissen_cache = analyzer.calculate_inbreeding_tabular(self.df)
-        
-        # Initialize a cache for the slower path-based results to avoid re-computation
+
+        # Compact SoA pedigree representation. The dataframe itself is
+        # not retained: everything the algorithms need lives in the
+        # arrays below, which keeps a long-lived calculator from pinning
+        # the full pedigree frame in memory.
+        self.ordered_ids, self.sires, self.dams = analyzer.positional_arrays(df)
+        self._animal_pos = {animal_id: i for i, animal_id in enumerate(self.ordered_ids)}
+
+        # Pre-calculate all Meuwissen-Luo IBCs for fast retrieval.
+        self._F = analyzer.inbreeding_from_arrays(self.sires, self.dams)
+        self.F_meuwissen_cache = {
+            animal_id: self._F[i] for i, animal_id in enumerate(self.ordered_ids)
+        }
+
+        # Initialize a cache for the slower path-based results (keyed by
+        # position) to avoid re-computation.
         self.F_path_cache = {}
 
+        # Per-animal cache of ancestor path lengths ({ancestor: [lengths]}),
+        # filled lazily by coancestry queries.
+        self._paths_cache = {}
+
+        # Memo for coancestry results; mating simulations query the same
+        # (sire, dam) pairs repeatedly. Keyed symmetrically by position.
+        self._coancestry_cache = {}
+
+        # Per-animal ancestor bitmasks, filled lazily; the same candidate
+        # sires and dams recur across pairings.
+        self._ancestors = {}
+
+    def _ancestors_of(self, pos):
+        """
+        Returns the cached ancestor bitmask for an animal (bit k set for
+        ancestor position k, including the animal itself). An animal's
+        mask is the OR of its parents' masks plus its own bit, so masks
+        are derived bottom-up from the cache - two big-int ORs per
+        yet-unseen ancestor - rather than re-walking the pedigree per
+        query, and every intermediate mask built along the way is kept
+        for later queries.
+        """
+        masks = self._ancestors
+        cached = masks.get(pos)
+        if cached is not None:
+            return cached
+
+        stack = [pos]
+        while stack:
+            current = stack[-1]
+            if current in masks:
+                stack.pop()
+                continue
+            s = int(self.sires[current])
+            d = int(self.dams[current])
+            pending = [p for p in (s, d) if p >= 0 and p not in masks]
+            if pending:
+                stack.extend(pending)
+                continue
+            mask = 1 << current
+            if s >= 0:
+                mask |= masks[s]
+            if d >= 0:
+                mask |= masks[d]
+            masks[current] = mask
+            stack.pop()
+        return masks[pos]
+
+    def _paths_of(self, pos):
+        """
+        Returns the cached {ancestor position: [path lengths]} dict for
+        an animal, computing it with a single BFS sweep on first use.
+        """
+        paths = self._paths_cache.get(pos)
+        if paths is None:
+            paths = analyzer.enumerate_all_paths(self.sires, self.dams, pos)
+            self._paths_cache[pos] = paths
+        return paths
+
     def get_inbreeding_meuwissen(self, animal_id):
         """
         Retrieves the pre-calculated Meuwissen-Luo inbreeding coefficient for an animal.
@@ -25,64 +99,118 @@ class PedigreeCalculator:
         # The cache keys are now strings, so we ensure the input is a string.
         return self.F_meuwissen_cache.get(str(animal_id), 0.0)
 
+    def get_inbreeding_batch(self, animal_ids):
+        """
+        Returns the pre-calculated Meuwissen-Luo coefficients for a whole
+        sequence of animal ids as a float array (0.0 for ids missing from
+        the pedigree). One gather from the F vector replaces a Python
+        method call and dict probe per animal at the call sites.
+        """
+        get_pos = self._animal_pos.get
+        positions = np.fromiter(
+            (get_pos(str(animal_id), -1) for animal_id in animal_ids),
+            dtype=np.int64,
+        )
+        values = np.zeros(positions.shape[0])
+        known = positions >= 0
+        values[known] = self._F[positions[known]]
+        return values
+
     def get_inbreeding_traditional(self, animal_id):
         """
-        Calculates the inbreeding coefficient for a single animal using the 
+        Calculates the inbreeding coefficient for a single animal using the
         traditional path-based algorithm. Caches results to speed up subsequent calls.
         """
+        pos = self._animal_pos.get(str(animal_id))
+        if pos is None:
+            return 0.0
         # It's critical that the F_path_cache is passed to and updated by the analyzer.
         return analyzer.calculate_inbreeding_path_based_for_animal(
-            self.df, str(animal_id), self.F_path_cache
+            self.sires, self.dams, pos, self.F_path_cache
         )
 
+    def calculate_coancestry_batch(self, sire_ids, dam_ids):
+        """
+        Calculates the coancestry of every sire x dam combination in one
+        shot and returns a len(sire_ids) x len(dam_ids) float array.
+
+        A hypothetical offspring's inbreeding equals the coancestry of
+        its parents, so a whole mating grid never needs the pedigree
+        extended and recomputed per pairing: the dense relationship
+        matrix is built once, restricted to the candidates (plus all
+        parents), and the grid is gathered as 0.5 * A[sire, dam] with a
+        single fancy-index. Animals missing from the pedigree get 0.
+        """
+        sire_ids = [str(s) for s in sire_ids]
+        dam_ids = [str(d) for d in dam_ids]
+        pos = self._animal_pos
+        sire_rows = [pos.get(s, -1) for s in sire_ids]
+        dam_cols = [pos.get(d, -1) for d in dam_ids]
+
+        # Reuse the SoA arrays built in __init__ rather than re-deriving
+        # them from the dataframe on every batch.
+        A = analyzer.relationship_matrix_from_arrays(
+            self.sires, self.dams,
+            query_positions=[p for p in sire_rows + dam_cols if p >= 0],
+        )
+
+        valid_rows = [i for i, p in enumerate(sire_rows) if p >= 0]
+        valid_cols = [j for j, p in enumerate(dam_cols) if p >= 0]
+
+        coancestry = np.zeros((len(sire_ids), len(dam_ids)))
+        if valid_rows and valid_cols:
+            gathered = 0.5 * A[np.ix_([sire_rows[i] for i in valid_rows],
+                                      [dam_cols[j] for j in valid_cols])]
+            coancestry[np.ix_(valid_rows, valid_cols)] = gathered
+        return coancestry
+
     def calculate_coancestry(self, sire_id, dam_id):
         """
         Calculates the coancestry between a sire and a dam, which is equivalent
         to the inbreeding coefficient of their hypothetical offspring.
-        
-        For performance during mating simulations, this method uses the fast, 
+
+        For performance during mating simulations, this method uses the fast,
         pre-calculated Meuwissen-Luo IBCs for the F-value of common ancestors.
         """
-        # The sire_id and dam_id are now strings, so the int conversion is removed.
-        sire_id, dam_id = str(sire_id), str(dam_id)
-
-        # A map is needed for efficient path finding.
-        df_map = {row.animal_id: (row.sire_id, row.dam_id) for row in self.df.itertuples()}
-
-        # Find all ancestors for both the sire and the dam to identify common ones.
-        q_sire, q_dam = [sire_id], [dam_id]
-        sire_ancestors, dam_ancestors = {sire_id}, {dam_id}
-        
-        head = 0
-        while head < len(q_sire):
-            curr = q_sire[head]; head+=1
-            p = df_map.get(curr)
-            if p: 
-                if pd.notna(p[0]) and p[0] not in sire_ancestors: sire_ancestors.add(p[0]); q_sire.append(p[0])
-                if pd.notna(p[1]) and p[1] not in sire_ancestors: sire_ancestors.add(p[1]); q_sire.append(p[1])
-
-        head = 0
-        while head < len(q_dam):
-            curr = q_dam[head]; head+=1
-            p = df_map.get(curr)
-            if p:
-                if pd.notna(p[0]) and p[0] not in dam_ancestors: dam_ancestors.add(p[0]); q_dam.append(p[0])
-                if pd.notna(p[1]) and p[1] not in dam_ancestors: dam_ancestors.add(p[1]); q_dam.append(p[1])
-                
-        common_ancestors = sire_ancestors.intersection(dam_ancestors)
-        
+        sire_pos = self._animal_pos.get(str(sire_id))
+        dam_pos = self._animal_pos.get(str(dam_id))
+        if sire_pos is None or dam_pos is None:
+            return 0.0
+
+        # Coancestry is symmetric, so cache under the ordered position pair.
+        key = (sire_pos, dam_pos) if sire_pos <= dam_pos else (dam_pos, sire_pos)
+        cached = self._coancestry_cache.get(key)
+        if cached is not None:
+            return cached
+
+        # Find all ancestors for both the sire and the dam to identify
+        # common ones; the per-animal bitmasks are cached across
+        # pairings and intersect with a single big-int AND.
+        common_ancestors = self._ancestors_of(sire_pos) & self._ancestors_of(dam_pos)
+
+        # One cached BFS sweep per animal answers the path query for
+        # every common ancestor at once.
+        sire_path_lengths = self._paths_of(sire_pos)
+        dam_path_lengths = self._paths_of(dam_pos)
+
+        # Local aliases keep the per-ancestor lookups on the fast path
+        # (LOAD_FAST) instead of repeated attribute/global resolution.
+        F = self._F
+        get_sire_paths = sire_path_lengths.get
+        get_dam_paths = dam_path_lengths.get
+
         total_coancestry = 0.0
-        for ancestor_id in common_ancestors:
+        for ancestor in analyzer.iter_mask_positions(common_ancestors):
             # For the ancestor's own inbreeding, use the fast tabular result for performance.
-            ancestor_inbreeding = self.get_inbreeding_meuwissen(ancestor_id)
-            
-            # Find all paths from the sire and dam to this common ancestor.
-            sire_paths = analyzer.find_all_paths_to_ancestor(df_map, sire_id, ancestor_id)
-            dam_paths = analyzer.find_all_paths_to_ancestor(df_map, dam_id, ancestor_id)
-            
+            ancestor_inbreeding = F[ancestor]
+
+            sire_paths = get_sire_paths(ancestor, [])
+            dam_paths = get_dam_paths(ancestor, [])
+
             # Sum the contributions for each combination of paths.
-            for n in sire_paths:
-                for m in dam_paths:
-                    total_coancestry += (0.5)**(n + m + 1) * (1 + ancestor_inbreeding)
-        
-        return total_coancestry
\ No newline at end of file
+            total_coancestry += analyzer.sum_path_contributions(
+                sire_paths, dam_paths, ancestor_inbreeding
+            )
+
+        self._coancestry_cache[key] = total_coancestry
+        return total_coancestry
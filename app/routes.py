@@ -1,20 +1,30 @@
-from flask import Blueprint, render_template, request, jsonify, current_app, Response, session, send_file
+from flask import Blueprint, render_template, stream_template, request, jsonify, current_app, Response, session, send_file
 import pandas as pd
 import numpy as np
+import hashlib
 import json
 import os
 import uuid
 from app.pedigree.calculator import PedigreeCalculator
-import logging
+import queue
+import threading
 from io import BytesIO
 import time
 
+try:
+    import xlsxwriter  # noqa: F401
+    # xlsxwriter serializes cells directly instead of building
+    # openpyxl's per-cell object tree. Its constant_memory mode is NOT
+    # safe here: it flushes rows as soon as a later row is touched, and
+    # to_excel writes column-major, so all but the first column would be
+    # silently dropped.
+    _EXCEL_WRITER_KWARGS = {'engine': 'xlsxwriter'}
+except ImportError:  # xlsxwriter is an optional accelerator
+    _EXCEL_WRITER_KWARGS = {'engine': 'openpyxl'}
+
 # Blueprints
 main_blueprint = Blueprint('main', __name__)
 
-# General app configuration
-logging.basicConfig(level=logging.INFO)
-
 # --- Main Blueprint Routes (Core App) ---
 
 @main_blueprint.route('/', methods=['GET'])
@@ -29,7 +39,15 @@ def upload_and_process():
     file = request.files['pedigree_file']
     start_time = time.time()
     try:
-        df = pd.read_csv(file, dtype=str).rename(columns=lambda x: x.strip().lower())
+        # Parse straight from the upload stream: the multipart body is
+        # already spooled by werkzeug, and reading it directly avoids
+        # ever materializing a second full copy of the file (as a .save()
+        # to disk followed by a re-read would).
+        # The C engine honors dtype=str during parsing; the pyarrow
+        # engine infers types first and casts back, which rewrites
+        # numeric-looking ear tags ('00101' -> '101') and corrupts the
+        # composite ids built from them.
+        df = pd.read_csv(file.stream, dtype=str).rename(columns=lambda x: x.strip().lower())
 
         expected_columns = {
             "faj", "fajta", "orszagkod", "fulszam", "szuletesi_ev", "ivar_kod",
@@ -81,22 +99,55 @@ def upload_and_process():
         current_app.logger.error(f"File processing error: {e}", exc_info=True)
         return jsonify({"error": f"Hiba a fájl feldolgozása közben: {e}"}), 500
 
+def _sessions_dir():
+    path = os.path.join(current_app.root_path, '..', 'tmp', 'sessions')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _session_df(session_id):
+    """
+    Loads a session's pedigree dataframe from its on-disk spill. Only
+    the calculator (compact positional arrays) stays resident between
+    requests; the full frame is read back for the few routes that need
+    the descriptive columns.
+    """
+    return pd.read_pickle(current_app.sessions[session_id]['data_path'])
+
 @main_blueprint.route('/start_calculation', methods=['POST'])
 def start_calculation():
     data = request.get_json()
     if not data:
         return jsonify({"error": 'Nincs adat a számításhoz.'}), 400
-    
+
     try:
         session_id = str(uuid.uuid4())
-        df = pd.DataFrame(data)
-        calculator = PedigreeCalculator(df)
-        current_app.sessions[session_id] = {'data': df, 'calculator': calculator}
+        # Re-submitting the same pedigree (page reload, second browser
+        # tab) should not redo the full IBC pre-computation, so finished
+        # calculators are memoized by content digest and shared between
+        # sessions; they are read-only after construction.
+        digest = hashlib.sha256(request.get_data()).hexdigest()
+        cached = current_app.calculator_cache.get(digest)
+        if cached is not None:
+            data_path, calculator = cached
+        else:
+            df = pd.DataFrame(data)
+            calculator = PedigreeCalculator(df)
+            # Spill the frame to disk keyed by content digest; sessions
+            # only hold the path, so per-session memory is just the
+            # calculator's arrays.
+            data_path = os.path.join(_sessions_dir(), f'{digest}.pkl')
+            df.to_pickle(data_path)
+            current_app.calculator_cache[digest] = (data_path, calculator)
+        current_app.sessions[session_id] = {'data_path': data_path, 'calculator': calculator}
         return jsonify({'session_id': session_id})
     except Exception as e:
         current_app.logger.error(f"Error starting calculation: {e}")
         return jsonify({'error': 'Szerverhiba a számítás előkészítésekor.'}), 500
 
+# Animals per SSE frame; one frame per animal made the stream dominated
+# by framing/JSON overhead and per-event DOM work on the client.
+_SSE_BATCH_SIZE = 128
+
 @main_blueprint.route('/calculate_ibcs')
 def calculate_ibcs_route():
     session_id = request.args.get('session_id')
@@ -111,22 +162,61 @@ def calculate_ibcs_route():
             start_time = time.time()
             try:
                 calculator = current_app.sessions[session_id]['calculator']
-                animal_ids = calculator.df['animal_id'].tolist()
+                animal_ids = _session_df(session_id)['animal_id'].tolist()
                 total_animals = len(animal_ids)
 
-                for i, animal_id in enumerate(animal_ids):
-                    data = {'animal_id': animal_id}
-                    
-                    if algorithm == 'meuwissen' or algorithm == 'both':
-                        data['ibc_meuwissen'] = calculator.get_inbreeding_meuwissen(animal_id)
-                    if algorithm == 'traditional' or algorithm == 'both':
-                        data['ibc_traditional'] = calculator.get_inbreeding_traditional(animal_id)
-
-                    progress = int(((i + 1) / total_animals) * 100)
-                    data['progress'] = progress
-                    
-                    yield f"data: {json.dumps(data)}\n\n"
-                
+                # Frames are computed on a worker thread and handed over
+                # through a bounded queue, so IBC computation overlaps
+                # with the socket writes instead of alternating with
+                # them. Each frame carries up to _SSE_BATCH_SIZE animals.
+                frames = queue.Queue(maxsize=4)
+                done = object()
+                # Set once the response generator is closed (client
+                # disconnect) or finished; the producer checks it so an
+                # abandoned stream cannot leak a thread blocked on a
+                # full queue.
+                cancelled = threading.Event()
+
+                def put_frame(item):
+                    while not cancelled.is_set():
+                        try:
+                            frames.put(item, timeout=1.0)
+                            return
+                        except queue.Full:
+                            pass
+
+                def produce_frames():
+                    try:
+                        for start in range(0, total_animals, _SSE_BATCH_SIZE):
+                            if cancelled.is_set():
+                                return
+                            batch = animal_ids[start:start + _SSE_BATCH_SIZE]
+                            animals = []
+                            for animal_id in batch:
+                                entry = {'animal_id': animal_id}
+                                if algorithm == 'meuwissen' or algorithm == 'both':
+                                    entry['ibc_meuwissen'] = calculator.get_inbreeding_meuwissen(animal_id)
+                                if algorithm == 'traditional' or algorithm == 'both':
+                                    entry['ibc_traditional'] = calculator.get_inbreeding_traditional(animal_id)
+                                animals.append(entry)
+                            progress = int(((start + len(batch)) / total_animals) * 100)
+                            put_frame({'animals': animals, 'progress': progress})
+                    except Exception as e:
+                        put_frame(e)
+                    put_frame(done)
+
+                threading.Thread(target=produce_frames, daemon=True).start()
+                try:
+                    while True:
+                        frame = frames.get()
+                        if frame is done:
+                            break
+                        if isinstance(frame, Exception):
+                            raise frame
+                        yield f"data: {json.dumps(frame)}\n\n"
+                finally:
+                    cancelled.set()
+
                 end_time = time.time()
                 calculation_time = round(end_time - start_time, 2)
                 yield f"event: complete\ndata: {json.dumps({'message': 'A számítás befejeződött.', 'calculation_time': calculation_time})}\n\n"
@@ -150,11 +240,13 @@ def get_animals(session_id):
     if not session_id or session_id not in current_app.sessions:
         return jsonify({"error": "Érvénytelen munkamenet"}), 404
     
-    df = current_app.sessions[session_id]['data'].copy()
+    # The loaded frame is private to this request, so it can be
+    # mutated below without a defensive copy.
+    df = _session_df(session_id)
     calculator = current_app.sessions[session_id]['calculator']
-    
-    # Safely get IBC values for each animal
-    df['ibc'] = df['animal_id'].apply(lambda id: calculator.get_inbreeding_meuwissen(id))
+
+    # Safely get IBC values for all animals in one gather
+    df['ibc'] = calculator.get_inbreeding_batch(df['animal_id'].tolist())
 
     # Standardize and fill missing values for farm and birth_year
     if 'farm' not in df.columns:
@@ -195,7 +287,9 @@ def export_results():
 
     try:
         pairings_data = data['pairings']
-        
+        if not pairings_data:
+            return "Hiba: Nincsenek párosítások az exportáláshoz.", 400
+
         output_df = pd.DataFrame(pairings_data)
 
         output_df.rename(columns={
@@ -218,7 +312,7 @@ def export_results():
         output_df = output_df[final_columns]
         
         output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        with pd.ExcelWriter(output, **_EXCEL_WRITER_KWARGS) as writer:
             output_df.to_excel(writer, index=False, sheet_name='Párosítási Eredmények')
         output.seek(0)
 
@@ -233,6 +327,21 @@ def export_results():
         current_app.logger.error(f"Error exporting results: {e}", exc_info=True)
         return "Hiba az exportálás során.", 500
 
+# Rows per JSON fragment when streaming the simulation results page.
+_RESULT_CHUNK_ROWS = 2000
+
+def _iter_results_json(results_df):
+    """
+    Yield the pairing results as successive JSON array fragments so the
+    rendered page can be streamed to the client chunk by chunk instead
+    of being materialized as one multi-megabyte string.
+    """
+    yield '['
+    for start in range(0, len(results_df), _RESULT_CHUNK_ROWS):
+        part = results_df.iloc[start:start + _RESULT_CHUNK_ROWS].to_dict(orient='records')
+        yield (',' if start else '') + json.dumps(part)[1:-1]
+    yield ']'
+
 @main_blueprint.route('/pedigree/simulation_results', methods=['POST'])
 def simulation_results():
     session_id = request.form.get('session_id')
@@ -240,37 +349,55 @@ def simulation_results():
         return "Hiba: Érvénytelen vagy lejárt munkamenet.", 400
 
     try:
-        df = current_app.sessions[session_id]['data'].copy()
+        sire_ids = [id for id in request.form.get('sire_ids', '').split(',') if id]
+        dam_ids = [id for id in request.form.get('dam_ids', '').split(',') if id]
+
+        # An empty selection produces an empty grid; answer it without
+        # touching the session frame or the calculator.
+        if not sire_ids or not dam_ids:
+            return stream_template('pedigree/simulation_result.html',
+                                   results_json=iter(('[]',)))
+
+        df = _session_df(session_id)
         calculator = current_app.sessions[session_id]['calculator']
 
         df['farm'] = df['farm'].fillna('Ismeretlen')
         df['birth_year'] = df['birth_year'].fillna('Ismeretlen')
 
-        sire_ids = [id for id in request.form.get('sire_ids', '').split(',') if id]
-        dam_ids = [id for id in request.form.get('dam_ids', '').split(',') if id]
-
-        sire_details = df[df['animal_id'].isin(sire_ids)].to_dict('records')
-        dam_details = df[df['animal_id'].isin(dam_ids)].to_dict('records')
-
-        results_data = []
-        for sire in sire_details:
-            sire_ibc = calculator.get_inbreeding_meuwissen(sire['animal_id'])
-            for dam in dam_details:
-                dam_ibc = calculator.get_inbreeding_meuwissen(dam['animal_id'])
-                offspring_ibc = calculator.calculate_coancestry(sire['animal_id'], dam['animal_id'])
-                results_data.append({
-                    'sire_id': sire['animal_id'],
-                    'sire_farm': sire['farm'],
-                    'sire_birth_year': sire['birth_year'],
-                    'sire_ibc': sire_ibc,
-                    'dam_id': dam['animal_id'],
-                    'dam_farm': dam['farm'],
-                    'dam_birth_year': dam['birth_year'],
-                    'dam_ibc': dam_ibc,
-                    'offspring_ibc': offspring_ibc
-                })
-        
-        return render_template('pedigree/simulation_result.html', results=results_data)
+        # A hash-indexed lookup frame answers both candidate detail
+        # pulls by key; the isin masks it replaces scanned the whole
+        # pedigree once per list. Selected ids missing from the
+        # pedigree are dropped, duplicates collapsed.
+        details = df.drop_duplicates(subset=['animal_id']).set_index('animal_id', drop=False)
+        sires = [s for s in dict.fromkeys(sire_ids) if s in details.index]
+        dams = [d for d in dict.fromkeys(dam_ids) if d in details.index]
+        sire_details = details.loc[sires]
+        dam_details = details.loc[dams]
+
+        # One relationship-matrix build answers the whole sire x dam
+        # grid; the cross product itself is assembled with repeat/tile
+        # instead of nested Python loops.
+        offspring_grid = calculator.calculate_coancestry_batch(sires, dams)
+
+        sire_ibcs = calculator.get_inbreeding_batch(sires)
+        dam_ibcs = calculator.get_inbreeding_batch(dams)
+
+        n_dams = len(dams)
+        results_df = pd.DataFrame({
+            'sire_id': np.repeat(sires, n_dams),
+            'sire_farm': np.repeat(sire_details['farm'].to_numpy(), n_dams),
+            'sire_birth_year': np.repeat(sire_details['birth_year'].to_numpy(), n_dams),
+            'sire_ibc': np.repeat(sire_ibcs, n_dams),
+            'dam_id': np.tile(dams, len(sires)),
+            'dam_farm': np.tile(dam_details['farm'].to_numpy(), len(sires)),
+            'dam_birth_year': np.tile(dam_details['birth_year'].to_numpy(), len(sires)),
+            'dam_ibc': np.tile(dam_ibcs, len(sires)),
+            'offspring_ibc': offspring_grid.ravel(),
+        })
+        # stream_template renders incrementally, so neither the full
+        # results JSON nor the full page is ever held in one buffer.
+        return stream_template('pedigree/simulation_result.html',
+                               results_json=_iter_results_json(results_df))
 
     except Exception as e:
         current_app.logger.error(f"Error in simulation results: {e}", exc_info=True)
@@ -1,28 +1,50 @@
 import random
 import sys
 
+# Rows are buffered and written in batches of this size to keep stdio
+# syscalls off the per-animal path.
+_FLUSH_EVERY = 1024
+
 def generate_complex_pedigree(num_animals=100):
     """
-    Generates and prints a complex, inbred pedigree in CSV format, 
+    Generates and prints a complex, inbred pedigree in CSV format,
     including farm_id and gender.
     """
-    print("animal_id,dam_id,sire_id,farm_id,gender")
+    rows = ["animal_id,dam_id,sire_id,farm_id,gender"]
+
+    def flush_rows():
+        sys.stdout.write('\n'.join(rows))
+        sys.stdout.write('\n')
+        rows.clear()
 
     farm_ids = [f"FARM-{chr(65+i)}" for i in range(7)]
     animal_farms = {}
     animal_genders = {}
     pedigree = {}
 
+    # Gender-partitioned candidate lists, maintained incrementally as
+    # animals are born instead of being rebuilt by scanning the full
+    # gender dict on every iteration.
+    available_dams = []
+    available_sires = []
+
+    def register(animal_id, farm, gender):
+        animal_farms[animal_id] = farm
+        animal_genders[animal_id] = gender
+        if gender == 'F':
+            available_dams.append(animal_id)
+        else:
+            available_sires.append(animal_id)
+
     # --- Generation 1: Founders ---
     founders = list(range(1, 11))
     for i, founder in enumerate(founders):
         farm = farm_ids[i % len(farm_ids)]
         gender = random.choice(['M', 'F'])
-        print(f"{founder},,,{farm},{gender}")
+        rows.append(f"{founder},,,{farm},{gender}")
         pedigree[founder] = (None, None)
-        animal_farms[founder] = farm
-        animal_genders[founder] = gender
-    
+        register(founder, farm, gender)
+
     next_id = 11
 
     def get_offspring_farm(dam_id, sire_id):
@@ -36,9 +58,6 @@ def generate_complex_pedigree(num_animals=100):
     # --- Subsequent Generations ---
     while next_id <= num_animals:
         try:
-            available_dams = [id for id, sex in animal_genders.items() if sex == 'F']
-            available_sires = [id for id, sex in animal_genders.items() if sex == 'M']
-
             if not available_dams or not available_sires:
                 continue # Cannot create offspring if one gender is missing
 
@@ -51,15 +70,20 @@ def generate_complex_pedigree(num_animals=100):
 
             farm = get_offspring_farm(dam, sire)
             gender = random.choice(['M', 'F'])
-            
-            print(f"{next_id},{dam},{sire},{farm},{gender}")
+
+            rows.append(f"{next_id},{dam},{sire},{farm},{gender}")
             pedigree[next_id] = (dam, sire)
-            animal_farms[next_id] = farm
-            animal_genders[next_id] = gender
+            register(next_id, farm, gender)
             next_id += 1
+
+            if len(rows) >= _FLUSH_EVERY:
+                flush_rows()
         except IndexError:
             continue
-        
+
+    if rows:
+        flush_rows()
+
 if __name__ == "__main__":
     # To run this from command line and save to a file:
     # python generate_pedigree.py > complex_pedigree_100.csv